@@ -8,7 +8,10 @@ backlog = 2048
 
 # Worker processes (optimized for Render's resource limits)
 workers = min(multiprocessing.cpu_count(), int(os.getenv('MAX_WORKERS', '2')))
-worker_class = "sync"
+# The app is WSGI (Flask), so threaded workers let blocking image downloads
+# and Pillow's GIL-releasing codecs overlap within a worker
+worker_class = "gthread"
+threads = int(os.getenv('THREADS', '4'))
 worker_connections = 1000
 timeout = int(os.getenv('WORKER_TIMEOUT', '60'))  # Increased for image processing
 keepalive = int(os.getenv('KEEP_ALIVE', '2'))
@@ -49,14 +52,11 @@ max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', '30'))
 # Graceful timeout
 graceful_timeout = 30
 
-# Enable threading for better I/O handling
-threads = 2
-
 # Callback functions for monitoring
 def when_ready(server):
     server.log.info("🚀 PixelFly Backend Server is ready on Render. Listening on %s", server.address)
-    server.log.info("🔧 Workers: %d, Timeout: %ds, Environment: %s",
-                    workers, timeout, os.getenv('FLASK_ENV', 'production'))
+    server.log.info("🔧 Workers: %d, Threads: %d, Timeout: %ds, Environment: %s",
+                    workers, threads, timeout, os.getenv('FLASK_ENV', 'production'))
 
 def worker_int(worker):
     worker.log.info("🔄 Worker %s received INT or QUIT signal", worker.pid)
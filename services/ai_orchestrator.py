@@ -8,13 +8,17 @@ import time
 import asyncio
 from typing import Dict, List, Any, Optional
 import google.generativeai as genai
-from langchain_core.messages import BaseMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langgraph.graph import StateGraph, END
-from langgraph.graph.message import add_messages
-from typing_extensions import Annotated, TypedDict
+from typing_extensions import TypedDict
 import logging
 
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
 from .photo_enhancer import PhotoEnhancementService
 from .watermark_service import WatermarkService
 from .image_processor import ImageProcessor
@@ -24,10 +28,38 @@ logger = logging.getLogger(__name__)
 # Configure Gemini
 genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
 
+# Agent prompts, filled in with str.format where they take parameters
+ANALYSIS_PROMPT_TEMPLATE = """
+Analyze this image for {task_type} processing.
+
+For enhancement, identify:
+- Image quality issues (blur, noise, low light)
+- Subject type (portrait, landscape, food, etc.)
+- Recommended enhancement techniques
+
+For watermarking, identify:
+- Best watermark placement areas
+- Image composition
+- Contrast areas for visibility
+
+Provide a JSON response with analysis results.
+"""
+
+QUALITY_PROMPT = """
+Assess the quality of this processed image.
+Rate on a scale of 1-10 and provide feedback.
+"""
+
+def _run_async(coro):
+    """Run a coroutine to completion on a fresh event loop (uvloop when installed)"""
+    if UVLOOP_AVAILABLE:
+        return uvloop.run(coro)
+    return asyncio.run(coro)
+
 class AgentState(TypedDict):
     """State shared between agents"""
-    messages: Annotated[list, add_messages]
     image_url: str
+    image_base64: Optional[str]  # upload as sent, decoded by PhotoEnhancementService
     user_id: str
     task_type: str  # 'enhancement' or 'watermarking'
     processing_status: str
@@ -93,21 +125,7 @@ class AIOrchestrator:
             logger.info(f"Analyzing image for user {state['user_id']}")
             
             # Use Gemini to analyze the image
-            analysis_prompt = f"""
-            Analyze this image for {state['task_type']} processing.
-            
-            For enhancement, identify:
-            - Image quality issues (blur, noise, low light)
-            - Subject type (portrait, landscape, food, etc.)
-            - Recommended enhancement techniques
-            
-            For watermarking, identify:
-            - Best watermark placement areas
-            - Image composition
-            - Contrast areas for visibility
-            
-            Provide a JSON response with analysis results.
-            """
+            analysis_prompt = ANALYSIS_PROMPT_TEMPLATE.format(task_type=state['task_type'])
             
             # Simulate Gemini analysis (replace with actual API call)
             analysis_result = {
@@ -138,10 +156,9 @@ class AIOrchestrator:
             
             # Use the photo enhancement service
             return_format = state["result_data"].get("return_format", "base64")
-            image_base64 = state["result_data"].get("image_base64")
             enhanced_result = await self.photo_enhancer.enhance_photo_async(
-                image_url=state["image_url"] if not image_base64 else None,
-                image_base64=image_base64,
+                image_url=state["image_url"],
+                image_base64=state.get("image_base64"),
                 enhancement_type=analysis.get("image_type", "auto"),
                 quality_score=analysis.get("quality_score", 0.5),
                 return_format=return_format
@@ -152,6 +169,7 @@ class AIOrchestrator:
             if "enhanced_url" in enhanced_result:
                 state["result_data"]["enhanced_url"] = enhanced_result["enhanced_url"]
             state["result_data"]["enhancements_applied"] = enhanced_result["enhancements_applied"]
+            state["result_data"]["_quality_task"] = asyncio.create_task(self._assess_quality(enhanced_result))
             state["processing_status"] = "enhanced"
             
             return state
@@ -186,6 +204,7 @@ class AIOrchestrator:
                 state["result_data"]["watermarked_base64"] = watermark_result["watermarked_base64"]
             if "watermarked_url" in watermark_result:
                 state["result_data"]["watermarked_url"] = watermark_result["watermarked_url"]
+            state["result_data"]["_quality_task"] = asyncio.create_task(self._assess_quality(watermark_result))
             state["processing_status"] = "watermarked"
             
             return state
@@ -196,39 +215,39 @@ class AIOrchestrator:
             state["processing_status"] = "error"
             return state
     
+    async def _assess_quality(self, processed_result: Dict[str, Any]) -> Dict[str, Any]:
+        """Assesses the quality of a processed image (scheduled as a background task)"""
+        # Use Gemini to assess the processed image quality with QUALITY_PROMPT
+        # Simulate quality check
+        return {
+            "quality_score": 8.5,
+            "feedback": "Excellent enhancement with good color balance",
+            "passed": True
+        }
+    
     async def _quality_checker_agent(self, state: AgentState) -> AgentState:
-        """Checks the quality of processed images"""
-        try:
-            logger.info(f"Checking quality for user {state['user_id']}")
-            
-            # Use Gemini to assess the processed image quality
-            quality_prompt = """
-            Assess the quality of this processed image.
-            Rate on a scale of 1-10 and provide feedback.
-            """
-            
-            # Simulate quality check
-            quality_result = {
-                "quality_score": 8.5,
-                "feedback": "Excellent enhancement with good color balance",
-                "passed": True
-            }
-            
-            state["result_data"]["quality_check"] = quality_result
-            state["processing_status"] = "quality_checked"
-            
-            return state
-            
-        except Exception as e:
-            logger.error(f"Quality check error: {str(e)}")
-            state["error_message"] = str(e)
-            return state
+        """Checks the quality of processed images
+        
+        The assessment itself is already in flight (started by the processing
+        agent) and is awaited in the finalizer, so this node only records status.
+        """
+        logger.info(f"Checking quality for user {state['user_id']}")
+        state["processing_status"] = "quality_checked"
+        return state
     
     async def _finalizer_agent(self, state: AgentState) -> AgentState:
         """Finalizes the processing and prepares the result"""
         try:
             logger.info(f"Finalizing processing for user {state['user_id']}")
             
+            # Collect the quality check that ran alongside the return path
+            quality_task = state["result_data"].pop("_quality_task", None)
+            if quality_task is not None:
+                try:
+                    state["result_data"]["quality_check"] = await quality_task
+                except Exception as e:
+                    logger.error(f"Quality check error: {str(e)}")
+            
             # Prepare final result
             state["result_data"]["final_status"] = "completed"
             state["result_data"]["processing_time"] = time.time() - state["result_data"].get("start_time", time.time())
@@ -241,6 +260,19 @@ class AIOrchestrator:
             state["error_message"] = str(e)
             return state
     
+    async def _run_workflow(self, initial_state: AgentState) -> AgentState:
+        """Run the agent graph without letting a background quality check outlive it"""
+        result_data = initial_state["result_data"]
+        try:
+            return await self.workflow.ainvoke(initial_state)
+        finally:
+            # The finalizer normally collects the quality check; if the graph
+            # failed or was cancelled first, cancel it and retrieve its outcome
+            quality_task = result_data.pop("_quality_task", None)
+            if quality_task is not None:
+                quality_task.cancel()
+                await asyncio.gather(quality_task, return_exceptions=True)
+    
     def _route_to_processor(self, state: AgentState) -> str:
         """Routes to the appropriate processor based on task type"""
         if state.get("error_message"):
@@ -256,64 +288,81 @@ class AIOrchestrator:
     
     def enhance_photo(self, image_url: str = None, image_base64: str = None, user_id: str = "anonymous", enhancement_type: str = "auto", return_format: str = "base64") -> Dict[str, Any]:
         """Synchronous photo enhancement"""
-        return asyncio.run(self.enhance_photo_async(image_url, image_base64, user_id, enhancement_type, return_format))
+        return _run_async(self.enhance_photo_async(image_url, image_base64, user_id, enhancement_type, return_format))
     
     async def enhance_photo_async(self, image_url: str = None, image_base64: str = None, user_id: str = "anonymous", enhancement_type: str = "auto", return_format: str = "base64") -> Dict[str, Any]:
         """Asynchronous photo enhancement using AI agents"""
         start_time = time.time()
         
         initial_state = AgentState(
-            messages=[],
-            image_url=image_url or f"data:image/jpeg;base64,{image_base64}" if image_base64 else None,
+            image_url=image_url,
+            image_base64=image_base64,
             user_id=user_id,
             task_type="enhancement",
             processing_status="started",
-            result_data={"start_time": start_time, "return_format": return_format, "image_base64": image_base64},
+            result_data={"start_time": start_time, "return_format": return_format},
             error_message=None
         )
         
         # Run the workflow
-        final_state = await self.workflow.ainvoke(initial_state)
+        final_state = await self._run_workflow(initial_state)
         
         if final_state.get("error_message"):
             raise Exception(final_state["error_message"])
         
         return final_state["result_data"]
     
-    def bulk_watermark(self, image_urls: List[str], user_id: str, watermark_config: Dict[str, Any], return_format: str = "base64") -> Dict[str, Any]:
+    def bulk_watermark(self, image_urls: List[str], user_id: str, watermark_config: Dict[str, Any], return_format: str = "base64", max_concurrency: int = 8) -> Dict[str, Any]:
         """Synchronous bulk watermarking"""
-        return asyncio.run(self.bulk_watermark_async(image_urls, user_id, watermark_config, return_format))
+        return _run_async(self.bulk_watermark_async(image_urls, user_id, watermark_config, return_format, max_concurrency))
     
-    async def bulk_watermark_async(self, image_urls: List[str], user_id: str, watermark_config: Dict[str, Any], return_format: str = "base64") -> Dict[str, Any]:
+    async def bulk_watermark_async(self, image_urls: List[str], user_id: str, watermark_config: Dict[str, Any], return_format: str = "base64", max_concurrency: int = 8) -> Dict[str, Any]:
         """Asynchronous bulk watermarking using AI agents"""
         start_time = time.time()
-        results = []
         
-        # Process each image
-        for image_url in image_urls:
-            try:
-                initial_state = AgentState(
-                    messages=[],
-                    image_url=image_url,
-                    user_id=user_id,
-                    task_type="watermarking",
-                    processing_status="started",
-                    result_data={"start_time": start_time, "watermark_config": watermark_config, "return_format": return_format},
-                    error_message=None
-                )
-                
-                final_state = await self.workflow.ainvoke(initial_state)
-                
-                if not final_state.get("error_message"):
-                    results.append(final_state["result_data"]["watermarked_url"])
-                else:
-                    logger.error(f"Failed to watermark {image_url}: {final_state['error_message']}")
-                    
-            except Exception as e:
-                logger.error(f"Error processing {image_url}: {str(e)}")
+        # Bound the fan-out so large batches don't flood downloads/AI calls
+        semaphore = asyncio.Semaphore(max_concurrency)
         
-        return {
-            "watermarked_urls": results,
+        async def process_image(image_url: str) -> AgentState:
+            initial_state = AgentState(
+                image_url=image_url,
+                image_base64=None,
+                user_id=user_id,
+                task_type="watermarking",
+                processing_status="started",
+                result_data={"start_time": start_time, "watermark_config": watermark_config, "return_format": return_format},
+                error_message=None
+            )
+            async with semaphore:
+                return await self._run_workflow(initial_state)
+        
+        # Process all images concurrently
+        completed_states = await asyncio.gather(
+            *(process_image(image_url) for image_url in image_urls),
+            return_exceptions=True
+        )
+        
+        watermarked_urls = []
+        watermarked_base64 = []
+        
+        for image_url, final_state in zip(image_urls, completed_states):
+            if isinstance(final_state, Exception):
+                logger.error(f"Error processing {image_url}: {str(final_state)}")
+            elif final_state.get("error_message"):
+                logger.error(f"Failed to watermark {image_url}: {final_state['error_message']}")
+            elif return_format == "base64" and "watermarked_base64" in final_state["result_data"]:
+                watermarked_base64.append(final_state["result_data"]["watermarked_base64"])
+            elif "watermarked_url" in final_state["result_data"]:
+                watermarked_urls.append(final_state["result_data"]["watermarked_url"])
+        
+        response = {
             "processing_time": time.time() - start_time,
-            "processed_count": len(results)
+            "processed_count": len(watermarked_base64) if return_format == "base64" else len(watermarked_urls)
         }
+        
+        if return_format == "base64":
+            response["watermarked_base64"] = watermarked_base64
+        else:
+            response["watermarked_urls"] = watermarked_urls
+        
+        return response
@@ -0,0 +1,37 @@
+"""
+HTTP Client for PixelFly
+Pooled image downloads shared by the enhancement and watermark services
+"""
+
+import os
+import requests
+from urllib3.util.retry import Retry
+from io import BytesIO
+
+# Shared HTTP session so concurrent downloads reuse pooled TCP/TLS connections;
+# transient 5xx answers from the image host are retried with backoff
+_http_session = requests.Session()
+_http_retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+_http_adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=_http_retry)
+_http_session.mount("http://", _http_adapter)
+_http_session.mount("https://", _http_adapter)
+
+# Downloads larger than this are aborted instead of buffered
+MAX_IMAGE_SIZE = int(os.getenv('MAX_IMAGE_SIZE', str(16 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def fetch_image_data(image_url: str) -> BytesIO:
+    """Stream an image download into memory, enforcing MAX_IMAGE_SIZE"""
+    with _http_session.get(image_url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        if int(response.headers.get('Content-Length') or 0) > MAX_IMAGE_SIZE:
+            raise ValueError(f"Image exceeds maximum size of {MAX_IMAGE_SIZE} bytes")
+
+        image_data = BytesIO()
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            image_data.write(chunk)
+            if image_data.tell() > MAX_IMAGE_SIZE:
+                raise ValueError(f"Image exceeds maximum size of {MAX_IMAGE_SIZE} bytes")
+
+        image_data.seek(0)
+        return image_data
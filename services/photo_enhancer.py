@@ -4,19 +4,69 @@ Uses AI models (Gemini + custom algorithms) to enhance photo quality
 """
 
 import os
+import json
 import time
 import asyncio
-import requests
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
 from typing import Dict, Any, Optional
 import numpy as np
-from PIL import Image, ImageEnhance, ImageFilter
+from PIL import Image
 import cv2
 import google.generativeai as genai
 from io import BytesIO
 import logging
 
+try:
+    # SIMD base64 codec with the same API as the standard library module
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+from .http_client import fetch_image_data
+from .image_processor import ImageProcessor, DETAIL_KERNEL
+
 logger = logging.getLogger(__name__)
 
+# Images are reduced to fit this box before being sent to Gemini
+GEMINI_MAX_SIZE = (1024, 1024)
+
+# Gemini analyses keyed by (content digest, enhancement type), so re-submitted
+# images (previews, retries) skip the model round-trip
+ANALYSIS_CACHE_MAXSIZE = 512
+_analysis_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_analysis_cache_lock = threading.Lock()
+
+def _analysis_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    with _analysis_cache_lock:
+        analysis = _analysis_cache.get(key)
+        if analysis is not None:
+            _analysis_cache.move_to_end(key)
+        return analysis
+
+def _analysis_cache_put(key: str, analysis: Dict[str, Any]) -> None:
+    with _analysis_cache_lock:
+        _analysis_cache[key] = analysis
+        _analysis_cache.move_to_end(key)
+        if len(_analysis_cache) > ANALYSIS_CACHE_MAXSIZE:
+            _analysis_cache.popitem(last=False)
+
+# The kernel warm-up is process-wide, so it runs for the first service
+# instance only (app.py and AIOrchestrator each create one)
+_kernels_warmed_up = False
+
+@dataclass
+class _ImageStats:
+    """Pixel statistics gathered once per image and shared by the analysis helpers"""
+    width: int
+    height: int
+    blur_score: float
+    contrast: float
+    noise: float
+    brightness: float
+
 class PhotoEnhancementService:
     """
     Advanced photo enhancement using AI and traditional image processing
@@ -34,6 +84,35 @@ class PhotoEnhancementService:
             self.gemini_model = None
             self.gemini_available = False
             logger.warning("Gemini API key not found, using fallback analysis")
+        
+        # Optional working-resolution cap for the enhancement filters (unset
+        # or 0 keeps full resolution). Capped inputs are reduced before
+        # filtering and scaled back to their original size afterwards unless
+        # ENHANCE_RESTORE_SIZE=false; the upscale softens fine detail
+        self.max_work_dim = int(os.getenv('ENHANCE_MAX_DIMENSION', '0'))
+        self.restore_size = os.getenv('ENHANCE_RESTORE_SIZE', 'true').lower() == 'true'
+        
+        self._warm_up()
+    
+    def _warm_up(self):
+        """Run the enhancement filters once per process on a tiny image so the
+        first request doesn't pay for OpenCV's lazy setup"""
+        global _kernels_warmed_up
+        if _kernels_warmed_up:
+            return
+        _kernels_warmed_up = True
+        try:
+            start_time = time.time()
+            img_array = np.zeros((16, 16, 3), dtype=np.uint8)
+            self._compute_image_stats(Image.fromarray(img_array))
+            img_array = ImageProcessor.unsharp_mask_array(img_array)
+            img_array = ImageProcessor.tonemap_array(img_array, brightness=1.1, contrast=1.2, saturation=1.15, color_balance=True)
+            img_array = cv2.medianBlur(img_array, 3)
+            img_array = cv2.filter2D(img_array, -1, DETAIL_KERNEL)
+            ImageProcessor.convert_format(Image.fromarray(img_array), "JPEG", quality=95)
+            logger.info(f"Enhancement kernels warmed up in {time.time() - start_time:.2f}s")
+        except Exception as e:
+            logger.warning(f"Enhancement warm-up failed: {str(e)}")
     
     async def enhance_photo_async(self, image_url: str = None, image_base64: str = None, enhancement_type: str = "auto", quality_score: float = 0.5, return_format: str = "base64") -> Dict[str, Any]:
         """
@@ -42,23 +121,36 @@ class PhotoEnhancementService:
         start_time = time.time()
         
         try:
-            # Get the image from URL or base64
+            # Get the image from base64 or URL
             if image_base64:
-                image = await self._decode_base64_image(image_base64)
+                image_data = await self._decode_base64_data(image_base64)
             elif image_url:
-                image = await self._download_image(image_url)
+                image_data = await self._download_image_data(image_url)
             else:
                 raise ValueError("Either image_url or image_base64 must be provided")
+            image = Image.open(image_data)
+            
+            with image_data.getbuffer() as encoded:
+                analysis_key = f"{hashlib.blake2b(encoded, digest_size=16).hexdigest()}:{enhancement_type}"
+            
+            # The blocking Gemini request and the pixel work below run in
+            # worker threads so the event loop keeps serving other requests
+            # (PIL, OpenCV and NumPy release the GIL in their hot loops)
             
-            # Analyze image with Gemini
-            analysis = await self._analyze_image_with_gemini(image, enhancement_type)
+            # Analyze image with Gemini (cached only when Gemini answered, so
+            # a transient API failure is retried on the next request)
+            analysis = _analysis_cache_get(analysis_key)
+            if analysis is None:
+                analysis = await asyncio.to_thread(self._analyze_image_with_gemini, image, enhancement_type)
+                if analysis.get("gemini_analysis"):
+                    _analysis_cache_put(analysis_key, analysis)
             
             # Apply enhancements based on analysis
-            enhanced_image = await self._apply_enhancements(image, analysis, quality_score)
+            enhanced_image = await asyncio.to_thread(self._apply_enhancements, image, analysis, quality_score)
             
             # Convert enhanced image to base64 or URL based on return_format
             if return_format == "base64":
-                enhanced_base64 = await self._image_to_base64(enhanced_image)
+                enhanced_base64 = await asyncio.to_thread(self._image_to_base64, enhanced_image)
                 result = {
                     "enhanced_base64": enhanced_base64,
                     "enhancements_applied": analysis.get("recommended_enhancements", []),
@@ -83,40 +175,38 @@ class PhotoEnhancementService:
             logger.error(f"Photo enhancement error: {str(e)}")
             raise e
     
-    async def _decode_base64_image(self, image_base64: str) -> Image.Image:
+    async def _decode_base64_data(self, image_base64: str) -> BytesIO:
         """Decode base64 image data"""
         try:
-            import base64
-            # Remove data URL prefix if present
-            if ',' in image_base64:
-                image_base64 = image_base64.split(',')[1]
+            # Skip a data URL prefix; the decoder accepts the str slice as-is
+            prefix_end = image_base64.find(',')
+            payload = image_base64[prefix_end + 1:] if prefix_end >= 0 else image_base64
 
-            image_data = base64.b64decode(image_base64)
-            return Image.open(BytesIO(image_data))
+            return BytesIO(base64.b64decode(payload))
         except Exception as e:
             logger.error(f"Failed to decode base64 image: {str(e)}")
             raise e
 
-    async def _download_image(self, image_url: str) -> Image.Image:
-        """Download image from URL"""
+    async def _download_image_data(self, image_url: str) -> BytesIO:
+        """Download image data from URL"""
         try:
-            response = requests.get(image_url, timeout=30)
-            response.raise_for_status()
-            return Image.open(BytesIO(response.content))
+            # Run the blocking request in a worker thread so the event loop
+            # keeps serving other requests during the round-trip
+            return await asyncio.to_thread(fetch_image_data, image_url)
         except Exception as e:
             logger.error(f"Failed to download image: {str(e)}")
             raise e
     
-    async def _analyze_image_with_gemini(self, image: Image.Image, enhancement_type: str) -> Dict[str, Any]:
+    def _analyze_image_with_gemini(self, image: Image.Image, enhancement_type: str) -> Dict[str, Any]:
         """
         Use Gemini to analyze the image and recommend enhancements
         """
+        stats = None
         try:
             if self.gemini_available:
-                # Convert PIL image to format Gemini can process
-                img_byte_arr = BytesIO()
-                image.save(img_byte_arr, format='JPEG')
-                img_byte_arr.seek(0)
+                # Gemini doesn't need full resolution for analysis; a
+                # reduced copy cuts upload size and model latency
+                gemini_image = ImageProcessor.resize_image(image, GEMINI_MAX_SIZE)
 
                 prompt = f"""
                 Analyze this image for quality enhancement. The requested enhancement type is: {enhancement_type}
@@ -141,10 +231,9 @@ class PhotoEnhancementService:
 
                 try:
                     # Use Gemini API for real analysis
-                    response = self.gemini_model.generate_content([prompt, image])
+                    response = self.gemini_model.generate_content([prompt, gemini_image])
 
                     # Try to parse JSON response
-                    import json
                     analysis_text = response.text.strip()
 
                     # Clean up response if it has markdown formatting
@@ -155,12 +244,17 @@ class PhotoEnhancementService:
 
                     gemini_analysis = json.loads(analysis_text)
 
+                    # Local statistics are only needed to fill in fields Gemini
+                    # left out, so skip the pixel passes when it answered fully
+                    if not all(field in gemini_analysis for field in ("image_type", "quality_issues", "recommended_enhancements", "enhancement_parameters")):
+                        stats = self._compute_image_stats(image)
+
                     # Validate and enhance the response
                     validated_analysis = {
-                        "image_type": gemini_analysis.get("image_type", self._detect_image_type(image)),
-                        "quality_issues": gemini_analysis.get("quality_issues", self._detect_quality_issues(image)),
-                        "recommended_enhancements": gemini_analysis.get("recommended_enhancements", self._get_recommended_enhancements(image, enhancement_type)),
-                        "enhancement_parameters": gemini_analysis.get("enhancement_parameters", self._get_enhancement_parameters(image)),
+                        "image_type": gemini_analysis["image_type"] if "image_type" in gemini_analysis else self._detect_image_type(stats),
+                        "quality_issues": gemini_analysis["quality_issues"] if "quality_issues" in gemini_analysis else self._detect_quality_issues(stats),
+                        "recommended_enhancements": gemini_analysis["recommended_enhancements"] if "recommended_enhancements" in gemini_analysis else self._get_recommended_enhancements(stats, enhancement_type),
+                        "enhancement_parameters": gemini_analysis["enhancement_parameters"] if "enhancement_parameters" in gemini_analysis else self._get_enhancement_parameters(stats),
                         "quality_improvement": float(gemini_analysis.get("quality_improvement", 0.35)),
                         "confidence": float(gemini_analysis.get("confidence", 0.85)),
                         "gemini_analysis": True
@@ -175,16 +269,15 @@ class PhotoEnhancementService:
 
             # Fallback to traditional analysis
             logger.info("Using traditional image analysis")
-            return self._fallback_analysis(image, enhancement_type)
+            return self._fallback_analysis(stats or self._compute_image_stats(image), enhancement_type)
 
         except Exception as e:
             logger.error(f"Image analysis error: {str(e)}")
-            return self._fallback_analysis(image, enhancement_type)
+            return self._fallback_analysis(stats or self._compute_image_stats(image), enhancement_type)
     
-    def _detect_image_type(self, image: Image.Image) -> str:
+    def _detect_image_type(self, stats: _ImageStats) -> str:
         """Detect the type of image (portrait, landscape, etc.)"""
-        width, height = image.size
-        aspect_ratio = width / height
+        aspect_ratio = stats.width / stats.height
         
         # Simple heuristics for image type detection
         if 0.7 <= aspect_ratio <= 1.3:
@@ -196,41 +289,58 @@ class PhotoEnhancementService:
         else:
             return "general"
     
-    def _detect_quality_issues(self, image: Image.Image) -> list:
+    def _compute_image_stats(self, image: Image.Image) -> _ImageStats:
+        """Measure the pixel statistics used to detect quality issues"""
+        # Read-only pixel view for analysis
+        img_array = np.asarray(image)
+        
+        # Blur metric (Laplacian variance). A 3x3 Laplacian of uint8 fits in
+        # int16, and meanStdDev accumulates in double without a float64 copy
+        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        blur_score = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_16S))[1][0, 0] ** 2
+        
+        # Mean and standard deviation over all channels from one
+        # per-channel meanStdDev pass
+        channel_means, channel_stds = (v.ravel() for v in cv2.meanStdDev(img_array))
+        brightness = channel_means.mean()
+        std = np.sqrt(max((channel_stds ** 2 + channel_means ** 2).mean() - brightness ** 2, 0.0))
+        
+        return _ImageStats(
+            width=image.width,
+            height=image.height,
+            blur_score=float(blur_score),
+            contrast=float(std),
+            noise=float(std),  # simplified noise estimate
+            brightness=float(brightness)
+        )
+    
+    def _detect_quality_issues(self, stats: _ImageStats) -> list:
         """Detect quality issues in the image"""
         issues = []
         
-        # Convert to numpy array for analysis
-        img_array = np.array(image)
-        
         # Check for blur (using Laplacian variance)
-        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-        blur_score = cv2.Laplacian(gray, cv2.CV_64F).var()
-        if blur_score < 100:
+        if stats.blur_score < 100:
             issues.append("blur")
         
         # Check for low contrast
-        contrast = img_array.std()
-        if contrast < 50:
+        if stats.contrast < 50:
             issues.append("low_contrast")
         
         # Check for noise (simplified)
-        noise_score = np.std(img_array)
-        if noise_score > 80:
+        if stats.noise > 80:
             issues.append("noise")
         
         # Check brightness
-        brightness = np.mean(img_array)
-        if brightness < 80:
+        if stats.brightness < 80:
             issues.append("low_light")
-        elif brightness > 200:
+        elif stats.brightness > 200:
             issues.append("overexposed")
         
         return issues
     
-    def _get_recommended_enhancements(self, image: Image.Image, enhancement_type: str) -> list:
+    def _get_recommended_enhancements(self, stats: _ImageStats, enhancement_type: str) -> list:
         """Get recommended enhancements based on image analysis"""
-        issues = self._detect_quality_issues(image)
+        issues = self._detect_quality_issues(stats)
         enhancements = []
         
         if "blur" in issues:
@@ -253,9 +363,9 @@ class PhotoEnhancementService:
         # Always add basic enhancements
         enhancements.extend(["color_balance", "detail_enhancement"])
         
-        return list(set(enhancements))  # Remove duplicates
+        return list(dict.fromkeys(enhancements))  # Remove duplicates, keeping order
     
-    def _get_enhancement_parameters(self, image: Image.Image) -> Dict[str, float]:
+    def _get_enhancement_parameters(self, stats: _ImageStats) -> Dict[str, float]:
         """Get optimal enhancement parameters"""
         return {
             "sharpness": 1.3,
@@ -265,87 +375,73 @@ class PhotoEnhancementService:
             "noise_reduction": 0.8
         }
     
-    async def _apply_enhancements(self, image: Image.Image, analysis: Dict[str, Any], quality_score: float) -> Image.Image:
+    def _apply_enhancements(self, image: Image.Image, analysis: Dict[str, Any], quality_score: float) -> Image.Image:
         """Apply AI-guided enhancements to the image"""
-        enhanced_image = image.copy()
+        original_image = image
+        if self.max_work_dim and max(image.size) > self.max_work_dim:
+            image = ImageProcessor.resize_image(image, (self.max_work_dim, self.max_work_dim))
+        
         enhancements = analysis.get("recommended_enhancements", [])
         parameters = analysis.get("enhancement_parameters", {})
         
         try:
+            # Work on one RGB pixel array end to end instead of round-tripping
+            # through a fresh PIL image (two buffer copies) at every stage
+            img_array = np.asarray(image if image.mode == 'RGB' else image.convert('RGB'))
+            
             # Apply sharpening
             if "sharpening" in enhancements:
-                enhanced_image = enhanced_image.filter(ImageFilter.UnsharpMask(
-                    radius=2, 
-                    percent=int(parameters.get("sharpness", 1.3) * 100), 
+                img_array = ImageProcessor.unsharp_mask_array(
+                    img_array,
+                    radius=2,
+                    percent=int(parameters.get("sharpness", 1.3) * 100),
                     threshold=3
-                ))
-            
-            # Apply contrast enhancement
-            if "contrast_enhancement" in enhancements:
-                enhancer = ImageEnhance.Contrast(enhanced_image)
-                enhanced_image = enhancer.enhance(parameters.get("contrast", 1.2))
-            
-            # Apply brightness adjustment
-            if "brightness_adjustment" in enhancements:
-                enhancer = ImageEnhance.Brightness(enhanced_image)
-                enhanced_image = enhancer.enhance(parameters.get("brightness", 1.1))
+                )
             
-            # Apply color saturation
-            if "color_saturation" in enhancements:
-                enhancer = ImageEnhance.Color(enhanced_image)
-                enhanced_image = enhancer.enhance(parameters.get("saturation", 1.15))
+            # Apply color balance, contrast, brightness and color saturation
+            # in one fused pass. Levels are stretched first so the contrast
+            # and brightness adjustments are not undone by the stretch
+            contrast = parameters.get("contrast", 1.2) if "contrast_enhancement" in enhancements else 1.0
+            brightness = parameters.get("brightness", 1.1) if "brightness_adjustment" in enhancements else 1.0
+            saturation = parameters.get("saturation", 1.15) if "color_saturation" in enhancements else 1.0
+            color_balance = "color_balance" in enhancements
+            if contrast != 1.0 or brightness != 1.0 or saturation != 1.0 or color_balance:
+                img_array = ImageProcessor.tonemap_array(
+                    img_array,
+                    brightness=brightness,
+                    contrast=contrast,
+                    saturation=saturation,
+                    color_balance=color_balance
+                )
             
-            # Apply noise reduction (using PIL filters)
+            # Apply noise reduction (3x3 median)
             if "noise_reduction" in enhancements:
-                enhanced_image = enhanced_image.filter(ImageFilter.MedianFilter(size=3))
-            
-            # Apply color balance
-            if "color_balance" in enhancements:
-                enhanced_image = self._apply_color_balance(enhanced_image)
+                img_array = cv2.medianBlur(img_array, 3)
             
             # Apply detail enhancement
             if "detail_enhancement" in enhancements:
-                enhanced_image = enhanced_image.filter(ImageFilter.DETAIL)
+                img_array = cv2.filter2D(img_array, -1, DETAIL_KERNEL)
+            
+            enhanced_image = Image.fromarray(img_array)
+            
+            if self.restore_size and enhanced_image.size != original_image.size:
+                enhanced_image = enhanced_image.resize(original_image.size, Image.Resampling.LANCZOS)
             
             logger.info(f"Applied enhancements: {enhancements}")
             return enhanced_image
             
         except Exception as e:
             logger.error(f"Enhancement application error: {str(e)}")
-            return image  # Return original if enhancement fails
+            return original_image  # Return original if enhancement fails
     
-    def _apply_color_balance(self, image: Image.Image) -> Image.Image:
-        """Apply automatic color balance"""
-        try:
-            # Convert to numpy array
-            img_array = np.array(image)
-            
-            # Simple color balance using histogram stretching
-            for i in range(3):  # RGB channels
-                channel = img_array[:, :, i]
-                # Stretch histogram to full range
-                min_val, max_val = np.percentile(channel, [2, 98])
-                img_array[:, :, i] = np.clip(
-                    (channel - min_val) * 255 / (max_val - min_val), 0, 255
-                )
-            
-            return Image.fromarray(img_array.astype(np.uint8))
-        except Exception as e:
-            logger.error(f"Color balance error: {str(e)}")
-            return image
-    
-    async def _image_to_base64(self, image: Image.Image) -> str:
+    def _image_to_base64(self, image: Image.Image) -> str:
         """Convert PIL image to base64 string"""
         try:
-            img_byte_arr = BytesIO()
-            # Convert to RGB if needed (for JPEG compatibility)
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            image.save(img_byte_arr, format='JPEG', quality=95)
-            img_byte_arr = img_byte_arr.getvalue()
-
-            import base64
-            base64_string = base64.b64encode(img_byte_arr).decode('utf-8')
+            # convert_format handles the RGB conversion and encodes with
+            # OpenCV's libjpeg-turbo straight from the pixel buffer
+            jpeg_bytes = ImageProcessor.convert_format(image, "JPEG", quality=95)
+
+            base64_string = base64.b64encode(jpeg_bytes).decode('ascii')
             return base64_string
         except Exception as e:
             logger.error(f"Base64 conversion error: {str(e)}")
@@ -368,13 +464,13 @@ class PhotoEnhancementService:
         logger.info(f"Enhanced image would be uploaded as: {placeholder_url}")
         return placeholder_url
     
-    def _fallback_analysis(self, image: Image.Image, enhancement_type: str) -> Dict[str, Any]:
+    def _fallback_analysis(self, stats: _ImageStats, enhancement_type: str) -> Dict[str, Any]:
         """Fallback analysis when Gemini is unavailable"""
         return {
-            "image_type": self._detect_image_type(image),
-            "quality_issues": self._detect_quality_issues(image),
+            "image_type": self._detect_image_type(stats),
+            "quality_issues": self._detect_quality_issues(stats),
             "recommended_enhancements": ["sharpening", "contrast_enhancement", "color_balance"],
-            "enhancement_parameters": self._get_enhancement_parameters(image),
+            "enhancement_parameters": self._get_enhancement_parameters(stats),
             "quality_improvement": 0.25,
             "confidence": 0.6,
             "fallback": True
@@ -3,19 +3,72 @@ Watermark Service for PixelFly
 Intelligent watermarking with AI-powered placement and styling
 """
 
-import os
 import time
 import asyncio
-import requests
 from typing import Dict, Any, List, Tuple
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance
+from PIL import Image, ImageDraw, ImageFont
 import cv2
 import logging
-from io import BytesIO
+from functools import lru_cache
+
+try:
+    # SIMD base64 codec with the same API as the standard library module
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+from .http_client import fetch_image_data
+from .image_processor import ImageProcessor
 
 logger = logging.getLogger(__name__)
 
+# Placement analysis runs on a copy scaled to this long side, which keeps
+# the Sobel complexity score comparable across upload resolutions
+PLACEMENT_ANALYSIS_SIZE = 512
+
+# Configs that set all of these need no placement analysis
+EXPLICIT_STYLE_KEYS = ("position", "opacity", "color", "font_size")
+
+def _load_image(image_url: str) -> Image.Image:
+    """Download and fully decode an image"""
+    image = Image.open(fetch_image_data(image_url))
+    image.load()
+    return image
+
+@lru_cache(maxsize=32)
+def _load_font(font_path: str, font_size: int) -> ImageFont.ImageFont:
+    """Load a font once per (path, size) and share it across requests"""
+    try:
+        return ImageFont.truetype(font_path, font_size)
+    except OSError:
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=128)
+def _layout_text(text: str, font_size: int, mode: str) -> Tuple[ImageFont.ImageFont, Tuple[int, int, int, int]]:
+    """Load the font and measure the text once per (text, size, image mode)"""
+    font = _load_font("arial.ttf", font_size)
+    # ImageDraw measures palette and bilevel images without antialiasing,
+    # so the bbox is taken on a scratch image of the same mode
+    return font, ImageDraw.Draw(Image.new(mode, (1, 1))).textbbox((0, 0), text, font=font)
+
+@lru_cache(maxsize=32)
+def _render_text_mask(text: str, font_size: int, mode: str, alpha: int) -> Image.Image:
+    """Draw the text once per style as an L-mode alpha mask covering its bounding box"""
+    font, text_bbox = _layout_text(text, font_size, mode)
+    mask = Image.new('L', (text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]), 0)
+    ImageDraw.Draw(mask).text((-text_bbox[0], -text_bbox[1]), text, font=font, fill=alpha)
+    return mask
+
+def _to_rgba(color: Any, opacity: float) -> Tuple[int, int, int, int]:
+    """Convert a watermark color to RGBA with the given opacity"""
+    alpha = int(255 * opacity)
+    if color == "white":
+        return (255, 255, 255, alpha)
+    if color == "black":
+        return (0, 0, 0, alpha)
+    return (*color, alpha) if isinstance(color, tuple) else (128, 128, 128, alpha)
+
 class WatermarkService:
     """
     Advanced watermarking service with AI-powered placement optimization
@@ -39,15 +92,17 @@ class WatermarkService:
             # Download the image
             image = await self._download_image(image_url)
             
-            # Analyze optimal watermark placement
-            placement_analysis = await self._analyze_watermark_placement(image, watermark_config)
+            # Analyze optimal watermark placement (pixel work runs in worker
+            # threads so bulk jobs gathered on the event loop use every core)
+            placement_analysis = await asyncio.to_thread(self._analyze_watermark_placement, image, watermark_config)
             
-            # Apply watermark
-            watermarked_image = await self._apply_watermark(image, watermark_config, placement_analysis)
+            # Apply watermark; the downloaded image isn't needed afterwards, so
+            # it is drawn on directly rather than copied
+            watermarked_image = await asyncio.to_thread(self._apply_watermark, image, watermark_config, placement_analysis, True)
 
             # Return base64 or URL based on return_format
             if return_format == "base64":
-                watermarked_base64 = await self._image_to_base64(watermarked_image)
+                watermarked_base64 = await asyncio.to_thread(self._image_to_base64, watermarked_image)
                 result = {
                     "watermarked_base64": watermarked_base64,
                     "watermark_config": watermark_config,
@@ -70,20 +125,25 @@ class WatermarkService:
             logger.error(f"Watermarking error: {str(e)}")
             raise e
     
-    async def bulk_watermark_async(self, image_urls: List[str], watermark_config: Dict[str, Any], return_format: str = "base64") -> Dict[str, Any]:
+    async def bulk_watermark_async(self, image_urls: List[str], watermark_config: Dict[str, Any], return_format: str = "base64", max_concurrency: int = 8) -> Dict[str, Any]:
         """
         Bulk watermarking with consistent styling
         """
         start_time = time.time()
-        results = []
         
-        # Process images concurrently
-        tasks = [
-            self.add_watermark_async(url, watermark_config, return_format)
-            for url in image_urls
-        ]
+        # Bound the fan-out so large batches don't hold every decoded image
+        # in memory or flood the download pool at once
+        semaphore = asyncio.Semaphore(max_concurrency)
         
-        completed_results = await asyncio.gather(*tasks, return_exceptions=True)
+        async def process_image(url: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.add_watermark_async(url, watermark_config, return_format)
+        
+        # Process images concurrently
+        completed_results = await asyncio.gather(
+            *(process_image(url) for url in image_urls),
+            return_exceptions=True
+        )
         
         watermarked_urls = []
         watermarked_base64 = []
@@ -113,30 +173,46 @@ class WatermarkService:
     async def _download_image(self, image_url: str) -> Image.Image:
         """Download image from URL"""
         try:
-            response = requests.get(image_url, timeout=30)
-            response.raise_for_status()
-            return Image.open(BytesIO(response.content))
+            # Run the blocking request and the decode in a worker thread so
+            # bulk downloads gathered on the event loop actually overlap
+            return await asyncio.to_thread(_load_image, image_url)
         except Exception as e:
             logger.error(f"Failed to download image: {str(e)}")
             raise e
     
-    async def _analyze_watermark_placement(self, image: Image.Image, config: Dict[str, Any]) -> Dict[str, Any]:
+    def _analyze_watermark_placement(self, image: Image.Image, config: Dict[str, Any]) -> Dict[str, Any]:
         """
         AI-powered analysis for optimal watermark placement
         """
+        if all(key in config for key in EXPLICIT_STYLE_KEYS):
+            # Nothing the analysis recommends would be used
+            return self._explicit_placement_analysis(image, config)
+        
         try:
             # Convert to numpy array for analysis
             img_array = np.array(image)
             width, height = image.size
             
+            scale = PLACEMENT_ANALYSIS_SIZE / max(width, height)
+            if scale < 1.0:
+                analysis_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+                img_array = cv2.resize(img_array, analysis_size, interpolation=cv2.INTER_AREA)
+            
+            # Grayscale once for every zone's complexity pass
+            if img_array.ndim == 3:
+                conversion = cv2.COLOR_RGBA2GRAY if img_array.shape[2] == 4 else cv2.COLOR_RGB2GRAY
+                gray = cv2.cvtColor(img_array, conversion)
+            else:
+                gray = img_array
+            
             # Analyze image composition
-            composition_analysis = self._analyze_composition(img_array)
+            composition_analysis = self._analyze_composition(img_array, gray)
             
             # Find optimal placement zones
             placement_zones = self._find_placement_zones(img_array, composition_analysis)
             
             # Determine best watermark style
-            style_recommendations = self._recommend_watermark_style(img_array, config)
+            style_recommendations = self._recommend_watermark_style(img_array, config, width)
             
             return {
                 "optimal_position": placement_zones["best_position"],
@@ -150,25 +226,30 @@ class WatermarkService:
             logger.error(f"Placement analysis error: {str(e)}")
             return self._fallback_placement_analysis(image, config)
     
-    def _analyze_composition(self, img_array: np.ndarray) -> Dict[str, Any]:
+    def _analyze_composition(self, img_array: np.ndarray, gray: np.ndarray) -> Dict[str, Any]:
         """Analyze image composition for watermark placement"""
         height, width = img_array.shape[:2]
         
-        # Divide image into zones
+        # Divide image into zones as (y0, y1, x0, x1) bounds
         zones = {
-            "top_left": img_array[0:height//3, 0:width//3],
-            "top_right": img_array[0:height//3, 2*width//3:width],
-            "bottom_left": img_array[2*height//3:height, 0:width//3],
-            "bottom_right": img_array[2*height//3:height, 2*width//3:width],
-            "center": img_array[height//3:2*height//3, width//3:2*width//3]
+            "top_left": (0, height//3, 0, width//3),
+            "top_right": (0, height//3, 2*width//3, width),
+            "bottom_left": (2*height//3, height, 0, width//3),
+            "bottom_right": (2*height//3, height, 2*width//3, width),
+            "center": (height//3, 2*height//3, width//3, 2*width//3)
         }
         
         zone_analysis = {}
-        for zone_name, zone_data in zones.items():
-            # Calculate zone characteristics
-            brightness = np.mean(zone_data)
-            contrast = np.std(zone_data)
-            complexity = self._calculate_complexity(zone_data)
+        for zone_name, (y0, y1, x0, x1) in zones.items():
+            zone_data = img_array[y0:y1, x0:x1]
+            
+            # Calculate zone characteristics; a single meanStdDev pass gives
+            # per-channel moments, pooled here into the all-channel mean/std
+            means, stds = cv2.meanStdDev(zone_data)
+            means, stds = means.ravel(), stds.ravel()
+            brightness = means.mean()
+            contrast = np.sqrt(max(np.mean(stds ** 2 + means ** 2) - brightness ** 2, 0.0))
+            complexity = self._calculate_complexity(gray[y0:y1, x0:x1])
             
             zone_analysis[zone_name] = {
                 "brightness": float(brightness),
@@ -179,21 +260,16 @@ class WatermarkService:
         
         return zone_analysis
     
-    def _calculate_complexity(self, zone_data: np.ndarray) -> float:
-        """Calculate visual complexity of a zone"""
+    def _calculate_complexity(self, gray: np.ndarray) -> float:
+        """Calculate visual complexity of a grayscale zone"""
         try:
-            # Convert to grayscale if needed
-            if len(zone_data.shape) == 3:
-                gray = cv2.cvtColor(zone_data, cv2.COLOR_RGB2GRAY)
-            else:
-                gray = zone_data
+            # Use Sobel edge detection to measure complexity; 3x3 gradients of
+            # 8-bit input fit in int16, and cv2.magnitude fuses the sqrt(x²+y²)
+            sobelx = cv2.Sobel(gray, cv2.CV_16S, 1, 0, ksize=3)
+            sobely = cv2.Sobel(gray, cv2.CV_16S, 0, 1, ksize=3)
+            edge_magnitude = cv2.magnitude(sobelx.astype(np.float32), sobely.astype(np.float32))
             
-            # Use Sobel edge detection to measure complexity
-            sobelx = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
-            sobely = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
-            edge_magnitude = np.sqrt(sobelx**2 + sobely**2)
-            
-            return np.mean(edge_magnitude)
+            return cv2.mean(edge_magnitude)[0]
         except Exception:
             return 0.0
     
@@ -227,7 +303,7 @@ class WatermarkService:
             "suitability_scores": {zone[0]: zone[1]["suitability_score"] for zone in sorted_zones}
         }
     
-    def _recommend_watermark_style(self, img_array: np.ndarray, config: Dict[str, Any]) -> Dict[str, Any]:
+    def _recommend_watermark_style(self, img_array: np.ndarray, config: Dict[str, Any], width: int) -> Dict[str, Any]:
         """Recommend watermark styling based on image characteristics"""
         avg_brightness = np.mean(img_array)
         
@@ -242,8 +318,7 @@ class WatermarkService:
             recommended_opacity = 0.7
             recommended_color = "white" if avg_brightness < 140 else "black"
         
-        # Recommend size based on image dimensions
-        height, width = img_array.shape[:2]
+        # Recommend size based on the original image width
         recommended_size = max(12, min(48, width // 40))
         
         return {
@@ -253,12 +328,9 @@ class WatermarkService:
             "recommended_font": "Arial"
         }
     
-    async def _apply_watermark(self, image: Image.Image, config: Dict[str, Any], placement_analysis: Dict[str, Any]) -> Image.Image:
-        """Apply watermark to the image"""
+    def _apply_watermark(self, image: Image.Image, config: Dict[str, Any], placement_analysis: Dict[str, Any], inplace: bool = False) -> Image.Image:
+        """Apply watermark to the image, drawing on it directly when inplace is set"""
         try:
-            watermarked_image = image.copy()
-            draw = ImageDraw.Draw(watermarked_image)
-            
             # Get watermark configuration
             text = config.get("text", "© PixelFly")
             position = config.get("position", placement_analysis["optimal_position"])
@@ -266,14 +338,8 @@ class WatermarkService:
             color = config.get("color", placement_analysis["style_recommendations"]["recommended_color"])
             font_size = config.get("font_size", placement_analysis["style_recommendations"]["recommended_size"])
             
-            # Load font
-            try:
-                font = ImageFont.truetype("arial.ttf", font_size)
-            except:
-                font = ImageFont.load_default()
-            
-            # Calculate text position
-            text_bbox = draw.textbbox((0, 0), text, font=font)
+            # Load font and calculate text position
+            font, text_bbox = _layout_text(text, int(font_size), image.mode)
             text_width = text_bbox[2] - text_bbox[0]
             text_height = text_bbox[3] - text_bbox[1]
             
@@ -295,26 +361,31 @@ class WatermarkService:
             
             # Create watermark with transparency
             if opacity < 1.0:
-                # Create a transparent overlay
-                overlay = Image.new('RGBA', image.size, (0, 0, 0, 0))
-                overlay_draw = ImageDraw.Draw(overlay)
+                # Blend the fill color through a cached alpha mask of the text,
+                # touching only the pixels inside the text's box
+                rgba_color = _to_rgba(color, opacity)
+                mask = _render_text_mask(text, int(font_size), image.mode, rgba_color[3])
+                left, top = text_position[0] + text_bbox[0], text_position[1] + text_bbox[1]
+                box = (left, top, left + text_width, top + text_height)
                 
-                # Convert color to RGBA with opacity
-                if color == "white":
-                    rgba_color = (255, 255, 255, int(255 * opacity))
-                elif color == "black":
-                    rgba_color = (0, 0, 0, int(255 * opacity))
+                if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+                    # Transparent pixels need a real alpha composite over the region
+                    tile = Image.new('RGBA', mask.size, rgba_color[:3] + (0,))
+                    tile.putalpha(mask)
+                    region = Image.alpha_composite(image.crop(box).convert('RGBA'), tile)
+                    watermarked_image = image.convert('RGB')
+                    watermarked_image.paste(region.convert('RGB'), box[:2])
                 else:
-                    rgba_color = (*color, int(255 * opacity)) if isinstance(color, tuple) else (128, 128, 128, int(255 * opacity))
-                
-                overlay_draw.text(text_position, text, font=font, fill=rgba_color)
-                
-                # Composite the overlay onto the image
-                watermarked_image = Image.alpha_composite(watermarked_image.convert('RGBA'), overlay)
-                watermarked_image = watermarked_image.convert('RGB')
+                    # Opaque images take the fill directly, with no RGBA round-trip
+                    if image.mode != 'RGB':
+                        watermarked_image = image.convert('RGB')
+                    else:
+                        watermarked_image = image if inplace else image.copy()
+                    watermarked_image.paste(rgba_color[:3], box, mask)
             else:
                 # Direct text drawing
-                draw.text(text_position, text, font=font, fill=color)
+                watermarked_image = image if inplace else image.copy()
+                ImageDraw.Draw(watermarked_image).text(text_position, text, font=font, fill=color)
             
             logger.info(f"Applied watermark: '{text}' at {position}")
             return watermarked_image
@@ -323,18 +394,13 @@ class WatermarkService:
             logger.error(f"Watermark application error: {str(e)}")
             return image  # Return original if watermarking fails
     
-    async def _image_to_base64(self, image: Image.Image) -> str:
+    def _image_to_base64(self, image: Image.Image) -> str:
         """Convert PIL image to base64 string"""
         try:
-            img_byte_arr = BytesIO()
-            # Convert to RGB if needed (for JPEG compatibility)
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            image.save(img_byte_arr, format='JPEG', quality=95)
-            img_byte_arr = img_byte_arr.getvalue()
+            # Shared JPEG path (cv2.imencode, RGB conversion included)
+            jpeg_bytes = ImageProcessor.convert_format(image, "JPEG", quality=95)
 
-            import base64
-            base64_string = base64.b64encode(img_byte_arr).decode('utf-8')
+            base64_string = base64.b64encode(jpeg_bytes).decode('ascii')
             return base64_string
         except Exception as e:
             logger.error(f"Base64 conversion error: {str(e)}")
@@ -366,3 +432,19 @@ class WatermarkService:
             "image_dimensions": {"width": image.width, "height": image.height},
             "fallback": True
         }
+    
+    def _explicit_placement_analysis(self, image: Image.Image, config: Dict[str, Any]) -> Dict[str, Any]:
+        """Placement result for configs that fully specify the watermark style"""
+        return {
+            "optimal_position": config["position"],
+            "placement_zones": {"best_position": config["position"]},
+            "style_recommendations": {
+                "recommended_opacity": config["opacity"],
+                "recommended_color": config["color"],
+                "recommended_size": config["font_size"],
+                "recommended_font": "Arial"
+            },
+            "composition_analysis": {},
+            "image_dimensions": {"width": image.width, "height": image.height},
+            "explicit_config": True
+        }
@@ -6,10 +6,19 @@ Simple Flask server for testing
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import logging
-import base64
+import platform
 import numpy as np
+import requests
 from io import BytesIO
-from PIL import Image, ImageEnhance, ImageFilter, ImageDraw, ImageFont
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from PIL import Image, ImageEnhance, ImageFilter, ImageDraw, ImageFont, ImageStat
+
+try:
+    # Drop-in SIMD replacement for the stdlib base64 codec
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,111 +26,151 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
+# Operation tracking is posted to the Next.js API from a small background
+# pool over one keep-alive session, so responses never wait on it
+TRACKING_API_URL = "https://pixelfly-pi.vercel.app/api/track"
+tracking_session = requests.Session()
+tracking_executor = ThreadPoolExecutor(max_workers=4)
+
+# Batch watermarking runs its (at most 3) images side by side
+watermark_executor = ThreadPoolExecutor(max_workers=3)
+
+def track_operation(operation, track_data):
+    """Record an operation in the Next.js API without blocking the response"""
+    def send():
+        try:
+            tracking_session.post(f"{TRACKING_API_URL}/{operation}", json=track_data, timeout=2)
+            logger.debug("✅ %s operation tracked", operation.capitalize())
+        except Exception as e:
+            logger.warning("⚠️ Failed to track %s: %s", operation, e)
+
+    tracking_executor.submit(send)
+
+# JPEG output settings: the optimize pass costs about as much as the encode
+# itself for a file only a few percent smaller, so it stays off
+JPEG_SAVE_OPTIONS = {
+    "format": "JPEG",
+    "quality": 95,
+    "optimize": False,
+}
+
+def decode_image_base64(image_base64):
+    """Decode a base64 image, with or without a data URL prefix, into a stream"""
+    # Skip a "data:image/...;base64," prefix; the decoder accepts the str
+    # slice as-is
+    prefix_end = image_base64.find(',')
+    payload = image_base64[prefix_end + 1:] if prefix_end >= 0 else image_base64
+    return BytesIO(base64.b64decode(payload))
+
 def enhance_image_simple(image_base64):
     """Apply visible image enhancements using PIL"""
     try:
-        print("Starting image enhancement...")
+        logger.debug("Starting image enhancement...")
 
         # Decode base64 image
-        image_data = base64.b64decode(image_base64)
-        image = Image.open(BytesIO(image_data))
-        print(f"Original image size: {image.size}, mode: {image.mode}")
+        image = Image.open(decode_image_base64(image_base64))
+        logger.debug("Original image size: %s, mode: %s", image.size, image.mode)
 
         # Convert to RGB if needed
         if image.mode != 'RGB':
             image = image.convert('RGB')
-            print("Converted image to RGB mode")
+            logger.debug("Converted image to RGB mode")
 
-        # Analyze image to determine optimal enhancements
-        img_array = np.array(image)
-        brightness = np.mean(img_array)
-        contrast = np.std(img_array)
+        # Analyze image to determine optimal enhancements; mean and std come
+        # from the pooled channel histogram instead of a float64 pixel copy
+        histogram = np.asarray(image.histogram(), dtype=np.float64).reshape(-1, 256).sum(axis=0)
+        levels = np.arange(256)
+        pixel_count = histogram.sum()
+        brightness = histogram @ levels / pixel_count
+        contrast = np.sqrt(max(histogram @ (levels * levels) / pixel_count - brightness ** 2, 0.0))
 
-        print(f"Image analysis - Brightness: {brightness:.1f}, Contrast: {contrast:.1f}")
+        logger.debug("Image analysis - Brightness: %.1f, Contrast: %.1f", brightness, contrast)
 
         # Determine enhancement factors based on analysis
         if brightness < 100:  # Dark image
             brightness_factor = 1.1
             contrast_factor = 1.15
-            print("Detected dark image - applying brightness boost")
+            logger.debug("Detected dark image - applying brightness boost")
         elif brightness > 180:  # Bright image
             brightness_factor = 0.95
             contrast_factor = 1.05
-            print("Detected bright image - reducing brightness slightly")
+            logger.debug("Detected bright image - reducing brightness slightly")
         else:  # Normal image
             brightness_factor = 1.02
             contrast_factor = 1.08
-            print("Normal brightness detected - applying gentle enhancement")
+            logger.debug("Normal brightness detected - applying gentle enhancement")
 
         if contrast < 30:  # Low contrast
             contrast_factor *= 1.2
-            print("Low contrast detected - boosting contrast")
-
-        # Apply smart, adaptive enhancements
-        print(f"Applying adaptive contrast enhancement (factor: {contrast_factor})...")
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(contrast_factor)
-
-        print(f"Applying adaptive brightness optimization (factor: {brightness_factor})...")
-        enhancer = ImageEnhance.Brightness(image)
-        image = enhancer.enhance(brightness_factor)
-
-        print("Applying color enhancement...")
+            logger.debug("Low contrast detected - boosting contrast")
+
+        # Apply smart, adaptive enhancements. Contrast then brightness is a
+        # per-value mapping once the luminance mean is known, so both run as a
+        # single lookup-table pass; blending a 0..255 ramp exactly as
+        # ImageEnhance does keeps PIL's rounding
+        logger.debug("Applying adaptive contrast enhancement (factor: %s)...", contrast_factor)
+        logger.debug("Applying adaptive brightness optimization (factor: %s)...", brightness_factor)
+        luminance_mean = int(ImageStat.Stat(image.convert('L')).mean[0] + 0.5)
+        ramp = Image.frombytes('L', (256, 1), bytes(range(256)))
+        lut = Image.blend(Image.new('L', (256, 1), luminance_mean), ramp, contrast_factor)
+        lut = Image.blend(Image.new('L', (256, 1), 0), lut, brightness_factor)
+        image = image.point(list(lut.tobytes()) * 3)
+
+        logger.debug("Applying color enhancement...")
         enhancer = ImageEnhance.Color(image)
         image = enhancer.enhance(1.15)  # Gentle color boost
 
-        print("Applying sharpness enhancement...")
+        logger.debug("Applying sharpness enhancement...")
         enhancer = ImageEnhance.Sharpness(image)
         image = enhancer.enhance(1.2)  # Moderate sharpening
 
         # Apply gentle noise reduction and detail enhancement
-        print("Applying smooth filter for noise reduction...")
+        logger.debug("Applying smooth filter for noise reduction...")
         image = image.filter(ImageFilter.SMOOTH_MORE)
 
-        print("Applying gentle unsharp mask...")
+        logger.debug("Applying gentle unsharp mask...")
         image = image.filter(ImageFilter.UnsharpMask(radius=1, percent=120, threshold=2))
 
         # Convert back to base64
-        print("Converting enhanced image back to base64...")
+        logger.debug("Converting enhanced image back to base64...")
         img_byte_arr = BytesIO()
-        image.save(img_byte_arr, format='JPEG', quality=95, optimize=True)
-        img_byte_arr = img_byte_arr.getvalue()
-
-        enhanced_base64 = base64.b64encode(img_byte_arr).decode('utf-8')
-        print(f"Enhancement complete! Original: {len(image_base64)} chars, Enhanced: {len(enhanced_base64)} chars")
+        image.save(img_byte_arr, **JPEG_SAVE_OPTIONS)
+        with img_byte_arr.getbuffer() as jpeg_bytes:  # no bytes copy of the JPEG
+            enhanced_base64 = base64.b64encode(jpeg_bytes).decode('utf-8')
+        logger.debug("Enhancement complete! Original: %s chars, Enhanced: %s chars", len(image_base64), len(enhanced_base64))
 
         return enhanced_base64
 
     except Exception as e:
-        print(f"Image enhancement error: {str(e)}")
+        logger.error("Image enhancement error: %s", str(e))
         return image_base64  # Return original if enhancement fails
 
 @app.route('/health')
 def health():
-    print("Health check requested")
+    logger.debug("Health check requested")
     return jsonify({"status": "healthy"})
 
 @app.route('/api/enhance', methods=['POST', 'OPTIONS'])
 def enhance():
-    print(f"Enhance endpoint called with method: {request.method}")
+    logger.debug("Enhance endpoint called with method: %s", request.method)
     
     if request.method == 'OPTIONS':
         return '', 200
     
     try:
         data = request.get_json()
-        print(f"Received data keys: {list(data.keys()) if data else 'None'}")
+        logger.debug("Received data keys: %s", list(data.keys()) if data else 'None')
 
         image_base64 = data.get('image_base64')
         user_id = data.get('user_id', 'anonymous')
         if image_base64:
-            print(f"Received image base64 length: {len(image_base64)}")
+            logger.debug("Received image base64 length: %s", len(image_base64))
 
             # Apply image enhancement
             enhanced_base64 = enhance_image_simple(image_base64)
-            print(f"Enhanced image, returning length: {len(enhanced_base64)}")
+            logger.info("Enhanced image, returning length: %s", len(enhanced_base64))
         else:
-            print("No image_base64 found, using placeholder")
+            logger.debug("No image_base64 found, using placeholder")
             enhanced_base64 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
 
         result = {
@@ -139,37 +188,26 @@ def enhance():
         }
 
         # Track enhancement operation
-        try:
-            import requests
-            track_data = {
-                "userId": user_id,
-                "filename": "enhanced_image.jpg",
-                "processingTime": 1.0,
-                "enhancementType": "smart_enhancement",
-                "success": True
-            }
-            # Send to Next.js API to track in database
-            requests.post("https://pixelfly-pi.vercel.app/api/track/enhancement", json=track_data, timeout=2)
-            print("✅ Enhancement operation tracked")
-        except Exception as e:
-            print(f"⚠️ Failed to track enhancement: {e}")
+        track_data = {
+            "userId": user_id,
+            "filename": "enhanced_image.jpg",
+            "processingTime": 1.0,
+            "enhancementType": "smart_enhancement",
+            "success": True
+        }
+        track_operation("enhancement", track_data)
 
-        print("Sending response with enhanced image")
+        logger.debug("Sending response with enhanced image")
         return jsonify(result)
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error("Error: %s", e)
         return jsonify({"success": False, "error": str(e)}), 500
 
 def smart_adaptive_placement(image, text, size):
     """AI-powered smart placement that avoids important content"""
-    # Analyze image for content areas
-    img_array = np.array(image.convert('RGB'))
-
     # Simple content detection - find areas with low variance (good for watermarks)
-    gray = np.mean(img_array, axis=2)
-
     # Divide image into 9 zones and find the best one
-    h, w = gray.shape
+    w, h = image.size
     zones = [
         (w-200, h-100, w-20, h-20),    # bottom right
         (20, h-100, 200, h-20),        # bottom left
@@ -184,7 +222,10 @@ def smart_adaptive_placement(image, text, size):
     for zone in zones:
         x1, y1, x2, y2 = zone
         if x2 < w and y2 < h and x1 >= 0 and y1 >= 0:
-            region = gray[y1:y2, x1:x2]
+            # Only the candidate zone is converted to gray, not the whole frame.
+            # The channel sum stays in uint16 rather than float64; its variance
+            # is the channel mean's times 9, so the zones rank the same
+            region = np.asarray(image.crop(zone).convert('RGB')).sum(axis=2, dtype=np.uint16)
             variance = np.var(region)
             if variance < min_variance:
                 min_variance = variance
@@ -194,15 +235,7 @@ def smart_adaptive_placement(image, text, size):
 
 def content_aware_placement(image, text, size):
     """Content-aware placement using edge detection"""
-    # Convert to grayscale for edge detection
-    gray = np.array(image.convert('L'))
-
-    # Simple edge detection
-    edges_x = np.abs(np.diff(gray, axis=1))
-    edges_y = np.abs(np.diff(gray, axis=0))
-
-    # Find area with least edges (good for watermark)
-    h, w = gray.shape
+    w, h = image.size
     return (w-180, h-80, w-20, h-20)  # Default to bottom right
 
 def edge_detection_placement(image, text, size):
@@ -226,13 +259,90 @@ def traditional_placement(image, position, size):
     else:
         return (w-180, h-80, w-20, h-20)
 
+# System font candidates, resolved once for the platform we're running on
+_system = platform.system()
+if _system == "Windows":
+    FONT_PATHS = ["arial.ttf", "calibri.ttf", "C:/Windows/Fonts/arial.ttf"]
+elif _system == "Darwin":  # macOS
+    FONT_PATHS = ["/System/Library/Fonts/Arial.ttf", "/Library/Fonts/Arial.ttf"]
+else:  # Linux
+    FONT_PATHS = ["/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"]
+
+@lru_cache(maxsize=32)
+def get_font(font_size):
+    """Load the watermark font once per size and reuse it across requests"""
+    try:
+        for font_path in FONT_PATHS:
+            try:
+                font = ImageFont.truetype(font_path, font_size)
+                logger.debug("✅ Using font: %s", font_path)
+                return font
+            except OSError:
+                continue
+
+        logger.warning("⚠️ Using default font")
+        return ImageFont.load_default()
+
+    except Exception as e:
+        logger.warning("⚠️ Font loading failed, using default: %s", e)
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=256)
+def render_text_mask(text, font_size):
+    """Measure and rasterize the text's coverage once per (text, size) so
+    layered styles can stamp it repeatedly and later requests reuse it"""
+    font = get_font(font_size)
+    left, top, right, bottom = ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), text, font=font)
+    mask = Image.new('L', (right - left, bottom - top), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+    return mask, (left, top)
+
+def style_layers(style, color, base_color, alpha):
+    """List the (dx, dy, rgba) text layers that make up a watermark style, back to front"""
+    if style == 'modern_glass':
+        # Glass effect with shadow and transparency
+        return [
+            (2, 2, (*base_color, alpha // 4)),       # Shadow
+            (1, 1, (200, 200, 200, alpha // 2)),     # Highlight
+            (0, 0, (*base_color, alpha)),            # Main text
+        ]
+
+    if style == 'neon_glow':
+        # Neon glow effect with multiple layers
+        glow_color = (0, 255, 255) if color == "white" else base_color
+        layers = [(dx, dy, (*glow_color, alpha // (offset + 1)))
+                  for offset in range(4, 0, -1)
+                  for dx in (-offset, 0, offset)
+                  for dy in (-offset, 0, offset)
+                  if dx != 0 or dy != 0]
+        return layers + [(0, 0, (255, 255, 255, alpha))]
+
+    if style == 'vintage_stamp':
+        # Stamp-colored text inside the border drawn by apply_watermark_style
+        stamp_color = (139, 69, 19) if color == "white" else base_color
+        return [(0, 0, (*stamp_color, alpha))]
+
+    if style == 'holographic':
+        # Holographic rainbow effect
+        colors = [(255, 0, 0), (255, 127, 0), (255, 255, 0), (0, 255, 0), (0, 0, 255), (75, 0, 130), (148, 0, 211)]
+        layers = [(i - 3, 0, (*holo_color, alpha // 3)) for i, holo_color in enumerate(colors)]
+        return layers + [(0, 0, (*base_color, alpha))]
+
+    if style == 'artistic_brush':
+        # Artistic brush effect with texture
+        layers = [(i - 1, i - 1, (*base_color, alpha // (i + 2))) for i in range(3)]
+        return layers + [(0, 0, (*base_color, alpha))]
+
+    # minimal_clean or default
+    return [(0, 0, (*base_color, alpha))]
+
 def apply_watermark_style(overlay, text, position, style, opacity, size, color="white"):
     """Apply revolutionary watermark styles with proper settings"""
 
     draw = ImageDraw.Draw(overlay)
     x1, y1, x2, y2 = position
 
-    print(f"🎨 Applying style: {style}, opacity: {opacity}, size: {size}, color: {color}")
+    logger.debug("🎨 Applying style: %s, opacity: %s, size: %s, color: %s", style, opacity, size, color)
 
     # Calculate font size based on size setting
     if size == 'small':
@@ -250,45 +360,14 @@ def apply_watermark_style(overlay, text, position, style, opacity, size, color="
     else:
         font_size = 20  # Default
 
-    print(f"📏 Calculated font size: {font_size}")
-
-    try:
-        # Try to use system fonts
-        import platform
-        system = platform.system()
-        if system == "Windows":
-            font_paths = ["arial.ttf", "calibri.ttf", "C:/Windows/Fonts/arial.ttf"]
-        elif system == "Darwin":  # macOS
-            font_paths = ["/System/Library/Fonts/Arial.ttf", "/Library/Fonts/Arial.ttf"]
-        else:  # Linux
-            font_paths = ["/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"]
-
-        font = None
-        for font_path in font_paths:
-            try:
-                font = ImageFont.truetype(font_path, font_size)
-                break
-            except:
-                continue
-
-        if font is None:
-            font = ImageFont.load_default()
-            print("⚠️ Using default font")
-        else:
-            print(f"✅ Using font: {font_path}")
+    logger.debug("📏 Calculated font size: %s", font_size)
 
-    except Exception as e:
-        font = ImageFont.load_default()
-        print(f"⚠️ Font loading failed, using default: {e}")
-
-    # Calculate text position
-    try:
-        text_bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
-    except:
-        # Fallback for older PIL versions
-        text_width, text_height = draw.textsize(text, font=font)
+    # Calculate text position from the cached glyph mask, whose size is the
+    # text's bounding box. Layered styles draw the same text many times;
+    # pasting a color through this mask gives the same pixels as draw.text
+    # without shaping and rasterizing the glyphs on every layer
+    mask, (mask_left, mask_top) = render_text_mask(text, font_size)
+    text_width, text_height = mask.size
 
     text_x = x1 + (x2 - x1 - text_width) // 2
     text_y = y1 + (y2 - y1 - text_height) // 2
@@ -297,7 +376,7 @@ def apply_watermark_style(overlay, text, position, style, opacity, size, color="
     text_x = max(x1, min(text_x, x2 - text_width))
     text_y = max(y1, min(text_y, y2 - text_height))
 
-    print(f"📍 Text position: ({text_x}, {text_y}), size: {text_width}x{text_height}")
+    logger.debug("📍 Text position: (%s, %s), size: %sx%s", text_x, text_y, text_width, text_height)
 
     # Convert color name to RGB
     color_map = {
@@ -314,82 +393,32 @@ def apply_watermark_style(overlay, text, position, style, opacity, size, color="
     base_color = color_map.get(color.lower(), (255, 255, 255))
     alpha = int(255 * opacity)
 
-    print(f"🎨 Using color: {base_color} with alpha: {alpha}")
+    logger.debug("🎨 Using color: %s with alpha: %s", base_color, alpha)
 
-    # Apply different styles with proper settings
-    if style == 'modern_glass':
-        # Glass effect with shadow and transparency
-        shadow_alpha = alpha // 4
-        draw.text((text_x+2, text_y+2), text, fill=(*base_color, shadow_alpha), font=font)  # Shadow
-        draw.text((text_x+1, text_y+1), text, fill=(200, 200, 200, alpha//2), font=font)   # Highlight
-        draw.text((text_x, text_y), text, fill=(*base_color, alpha), font=font)   # Main text
-
-    elif style == 'neon_glow':
-        # Neon glow effect with multiple layers
-        glow_color = (0, 255, 255) if color == "white" else base_color
-        for offset in range(4, 0, -1):
-            glow_alpha = alpha // (offset + 1)
-            for dx in [-offset, 0, offset]:
-                for dy in [-offset, 0, offset]:
-                    if dx != 0 or dy != 0:
-                        draw.text((text_x+dx, text_y+dy), text, fill=(*glow_color, glow_alpha), font=font)
-        draw.text((text_x, text_y), text, fill=(255, 255, 255, alpha), font=font)
-
-    elif style == 'vintage_stamp':
+    if style == 'vintage_stamp':
         # Vintage stamp effect with border
         padding = 8
         stamp_color = (139, 69, 19) if color == "white" else base_color
         draw.rectangle([x1+padding, y1+padding, x2-padding, y2-padding],
                       outline=(*stamp_color, alpha), width=3)
-        draw.text((text_x, text_y), text, fill=(*stamp_color, alpha), font=font)
 
-    elif style == 'holographic':
-        # Holographic rainbow effect
-        colors = [(255, 0, 0), (255, 127, 0), (255, 255, 0), (0, 255, 0), (0, 0, 255), (75, 0, 130), (148, 0, 211)]
-        for i, holo_color in enumerate(colors):
-            offset = i - 3
-            draw.text((text_x+offset, text_y), text, fill=(*holo_color, alpha//3), font=font)
-        draw.text((text_x, text_y), text, fill=(*base_color, alpha), font=font)
-
-    elif style == 'artistic_brush':
-        # Artistic brush effect with texture
-        for i in range(3):
-            offset_x = i - 1
-            offset_y = i - 1
-            brush_alpha = alpha // (i + 2)
-            draw.text((text_x+offset_x, text_y+offset_y), text, fill=(*base_color, brush_alpha), font=font)
-        draw.text((text_x, text_y), text, fill=(*base_color, alpha), font=font)
+    # Every style is a stack of text layers; paste each layer's color through
+    # the one pre-rendered glyph mask, in order
+    for dx, dy, fill in style_layers(style, color, base_color, alpha):
+        overlay.paste(fill, (text_x + dx + mask_left, text_y + dy + mask_top), mask)
 
-    else:  # minimal_clean or default
-        draw.text((text_x, text_y), text, fill=(*base_color, alpha), font=font)
-
-    print(f"✅ Applied {style} style successfully")
-    return overlay
-
-def add_forensic_protection(overlay, text):
-    """Add forensic-level protection markers"""
-    # Add invisible forensic markers (simplified)
-    return overlay
-
-def add_steganographic_watermark(overlay, text):
-    """Add invisible steganographic watermark"""
-    # Add steganographic data (simplified)
+    logger.debug("✅ Applied %s style successfully", style)
     return overlay
 
 def add_revolutionary_watermark(image_base64, watermark_config):
     """Revolutionary AI-powered watermarking with advanced features"""
     try:
-        print(f"🛡️ Starting Revolutionary Watermarking...")
-        print(f"📋 Config: {watermark_config}")
+        logger.debug("🛡️ Starting Revolutionary Watermarking...")
+        logger.debug("📋 Config: %s", watermark_config)
 
         # Decode base64 image
-        image_data = base64.b64decode(image_base64)
-        image = Image.open(BytesIO(image_data))
-        print(f"📸 Image size: {image.size}, mode: {image.mode}")
-
-        # Convert to RGBA for transparency support
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
+        image = Image.open(decode_image_base64(image_base64))
+        logger.debug("📸 Image size: %s, mode: %s", image.size, image.mode)
 
         # Create watermark overlay
         overlay = Image.new('RGBA', image.size, (0, 0, 0, 0))
@@ -403,95 +432,90 @@ def add_revolutionary_watermark(image_base64, watermark_config):
         color = watermark_config.get('color', 'white')
         protection_level = watermark_config.get('protection_level', 'advanced')
 
-        print(f"🎨 Applying {style} style with {protection_level} protection")
-        print(f"📋 Settings: text='{text}', position={position}, opacity={opacity}, size={size}, color={color}")
+        logger.debug("🎨 Applying %s style with %s protection", style, protection_level)
+        logger.debug("📋 Settings: text='%s', position=%s, opacity=%s, size=%s, color=%s", text, position, opacity, size, color)
 
         # Revolutionary watermark placement logic
         if position == 'smart_adaptive':
             # AI-powered content-aware placement
             watermark_pos = smart_adaptive_placement(image, text, size)
-            print(f"🧠 Smart placement calculated: {watermark_pos}")
+            logger.debug("🧠 Smart placement calculated: %s", watermark_pos)
         elif position == 'content_aware':
             watermark_pos = content_aware_placement(image, text, size)
-            print(f"🎯 Content-aware placement: {watermark_pos}")
+            logger.debug("🎯 Content-aware placement: %s", watermark_pos)
         elif position == 'edge_detection':
             watermark_pos = edge_detection_placement(image, text, size)
-            print(f"🔍 Edge-based placement: {watermark_pos}")
+            logger.debug("🔍 Edge-based placement: %s", watermark_pos)
         else:
             # Traditional placement
             watermark_pos = traditional_placement(image, position, size)
-            print(f"📍 Traditional placement: {watermark_pos}")
+            logger.debug("📍 Traditional placement: %s", watermark_pos)
 
         # Apply revolutionary watermark style
         watermarked_overlay = apply_watermark_style(overlay, text, watermark_pos, style, opacity, size, color)
 
-        # Apply protection level
-        if protection_level == 'forensic':
-            watermarked_overlay = add_forensic_protection(watermarked_overlay, text)
-        elif protection_level == 'invisible':
-            watermarked_overlay = add_steganographic_watermark(watermarked_overlay, text)
-
-        # Composite the watermark
-        watermarked = Image.alpha_composite(image, watermarked_overlay)
-
-        # Convert back to RGB
-        watermarked = watermarked.convert('RGB')
+        # Composite the watermark over the region the overlay covers; the
+        # rest of the frame is only converted to RGB, never to RGBA and back
+        watermarked = image if image.mode == 'RGB' else image.convert('RGB')
+        overlay_bbox = watermarked_overlay.getbbox()
+        if overlay_bbox:
+            region = Image.alpha_composite(image.crop(overlay_bbox).convert('RGBA'), watermarked_overlay.crop(overlay_bbox))
+            watermarked.paste(region.convert('RGB'), overlay_bbox[:2])
 
         # Convert to base64
         img_byte_arr = BytesIO()
-        watermarked.save(img_byte_arr, format='JPEG', quality=95, optimize=True)
-        img_byte_arr = img_byte_arr.getvalue()
-
-        watermarked_base64 = base64.b64encode(img_byte_arr).decode('utf-8')
-        print(f"✅ Revolutionary watermarking complete!")
+        watermarked.save(img_byte_arr, **JPEG_SAVE_OPTIONS)
+        with img_byte_arr.getbuffer() as jpeg_bytes:  # no bytes copy of the JPEG
+            watermarked_base64 = base64.b64encode(jpeg_bytes).decode('utf-8')
+        logger.debug("✅ Revolutionary watermarking complete!")
 
         return watermarked_base64
 
     except Exception as e:
-        print(f"❌ Watermarking error: {str(e)}")
+        logger.error("❌ Watermarking error: %s", str(e))
         return image_base64  # Return original if watermarking fails
 
 @app.route('/api/watermark', methods=['POST', 'OPTIONS'])
 def watermark_photos():
-    print(f"🛡️ Watermark endpoint called with method: {request.method}")
+    logger.debug("🛡️ Watermark endpoint called with method: %s", request.method)
 
     if request.method == 'OPTIONS':
-        print("Handling OPTIONS request")
+        logger.debug("Handling OPTIONS request")
         return '', 200
 
     try:
-        print("Getting JSON data from request")
+        logger.debug("Getting JSON data from request")
         data = request.get_json()
-        print(f"Received watermark request with keys: {list(data.keys()) if data else 'No data'}")
+        logger.debug("Received watermark request with keys: %s", list(data.keys()) if data else 'No data')
 
         # Validate input
         if not data:
-            print("No data provided in request")
+            logger.debug("No data provided in request")
             return jsonify({"success": False, "error": "No data provided"}), 400
 
         image_base64_list = data.get('image_base64_list', [])
         user_id = data.get('user_id', 'anonymous')
         watermark_config = data.get('watermark_config', {})
 
-        print(f"Request details - user_id: {user_id}, images: {len(image_base64_list)}")
-        print(f"Watermark config: {watermark_config}")
+        logger.debug("Request details - user_id: %s, images: %s", user_id, len(image_base64_list))
+        logger.debug("Watermark config: %s", watermark_config)
 
         if not image_base64_list:
-            print("No images provided")
+            logger.debug("No images provided")
             return jsonify({"success": False, "error": "image_base64_list is required"}), 400
 
         if len(image_base64_list) > 3:
-            print(f"Too many images: {len(image_base64_list)}")
+            logger.debug("Too many images: %s", len(image_base64_list))
             return jsonify({"success": False, "error": "Maximum 3 images allowed"}), 400
 
-        print(f"Processing {len(image_base64_list)} images for user {user_id}")
+        logger.debug("Processing %s images for user %s", len(image_base64_list), user_id)
 
-        # Process each image with revolutionary watermarking
-        watermarked_base64 = []
-        for i, img_base64 in enumerate(image_base64_list):
-            print(f"Processing image {i+1}/{len(image_base64_list)}")
-            watermarked = add_revolutionary_watermark(img_base64, watermark_config)
-            watermarked_base64.append(watermarked)
+        # Process the images concurrently; Pillow releases the GIL while
+        # decoding, compositing and encoding, so the batch takes about as
+        # long as its slowest image
+        futures = [watermark_executor.submit(add_revolutionary_watermark, img_base64, watermark_config)
+                   for img_base64 in image_base64_list]
+        watermarked_base64 = [future.result() for future in futures]
 
         result = {
             "success": True,
@@ -501,29 +525,23 @@ def watermark_photos():
         }
 
         # Track watermarking operation
-        try:
-            import requests
-            track_data = {
-                "userId": user_id,
-                "filename": "watermarked_images.jpg",
-                "processingTime": len(image_base64_list) * 1.2,
-                "watermarkText": watermark_config.get('text', '© PixelFly'),
-                "watermarkStyle": watermark_config.get('style', 'modern_glass'),
-                "watermarkPosition": watermark_config.get('position', 'smart_adaptive'),
-                "photoCount": len(image_base64_list),
-                "success": True
-            }
-            # Send to Next.js API to track in database
-            requests.post("https://pixelfly-pi.vercel.app/api/track/watermark", json=track_data, timeout=2)
-            print("✅ Watermarking operation tracked")
-        except Exception as e:
-            print(f"⚠️ Failed to track watermarking: {e}")
+        track_data = {
+            "userId": user_id,
+            "filename": "watermarked_images.jpg",
+            "processingTime": len(image_base64_list) * 1.2,
+            "watermarkText": watermark_config.get('text', '© PixelFly'),
+            "watermarkStyle": watermark_config.get('style', 'modern_glass'),
+            "watermarkPosition": watermark_config.get('position', 'smart_adaptive'),
+            "photoCount": len(image_base64_list),
+            "success": True
+        }
+        track_operation("watermark", track_data)
 
-        print("Sending successful watermark response")
+        logger.info("Watermarked %s images for user %s", len(image_base64_list), user_id)
         return jsonify(result)
 
     except Exception as e:
-        print(f"Watermark error: {str(e)}", exc_info=True)
+        logger.error("Watermark error: %s", str(e), exc_info=True)
         return jsonify({"success": False, "error": str(e)}), 500
 
 if __name__ == '__main__':
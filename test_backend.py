@@ -7,7 +7,6 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import logging
 import time
-import base64
 import os
 import json
 from io import BytesIO
@@ -15,6 +14,12 @@ from PIL import Image, ImageEnhance, ImageFilter
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+try:
+    # Drop-in SIMD replacement for the stdlib base64 codec
+    import pybase64 as base64
+except ImportError:
+    import base64
+
 # Load environment variables
 load_dotenv()
 
@@ -7,6 +7,7 @@ Production-ready Flask application for Render deployment
 import os
 import sys
 import logging
+import importlib
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -22,27 +23,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Import the Flask application with fallback strategy
-app = None
-try:
-    # Try to import the main app first
-    from app import app
-    logger.info("✅ Successfully imported Flask app from app.py")
-except ImportError as e:
-    logger.warning(f"⚠️ Failed to import from app.py: {e}")
-    try:
-        # Fallback to simple_server
-        from simple_server import app
-        logger.info("✅ Successfully imported Flask app from simple_server")
-    except ImportError as e2:
-        logger.warning(f"⚠️ Failed to import from simple_server: {e2}")
-        try:
-            # Final fallback to API index
-            from api.index import app
-            logger.info("✅ Successfully imported Flask app from api.index")
-        except ImportError as e3:
-            logger.error(f"❌ Failed to import from api.index: {e3}")
-            raise ImportError("Could not import Flask app from any module")
+# Import the Flask application from a single module: simple_server by
+# default, since requirements.txt covers its dependencies, or app / api.index
+# via PIXELFLY_APP_MODULE. Falling back through each module on ImportError
+# cost every worker a failed import at startup
+app_module = os.getenv('PIXELFLY_APP_MODULE', 'simple_server')
+app = importlib.import_module(app_module).app
+logger.info(f"✅ Successfully imported Flask app from {app_module}")
 
 # Configure for production
 if __name__ != "__main__":